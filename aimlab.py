@@ -0,0 +1,39 @@
+import sqlite3
+
+# query_scenario_scores needs window functions
+MIN_SQLITE_VERSION = (3, 25, 0)
+
+
+def fill_level_filter(con: sqlite3.Connection, cs_level_ids: dict, blacklist: dict, names, after: dict = None) -> None:
+    """ Load the tracked taskNames with their scenario name and blacklist date into a temp table to join against.
+        after maps names to the (highscore, average) createDates that only later runs may update. """
+    after = after or {}
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS level_filter '
+                '(taskName TEXT PRIMARY KEY, name TEXT, since TEXT, hs_after TEXT, avg_after TEXT)')
+    con.execute('DELETE FROM temp.level_filter')
+    con.executemany('INSERT INTO temp.level_filter VALUES (?, ?, ?, ?, ?)',
+                    [(csid, name, str(blacklist[name]), *after.get(name, ('', '')))
+                     for csid, name in cs_level_ids.items() if name in names])
+
+
+def query_scenario_scores(con: sqlite3.Connection, num_runs: int) -> list:
+    """ (name, highscore, average of the last num_runs runs, createDate of the newest run) for every
+        played scenario in level_filter. The scores are None if there are no runs after hs_after/avg_after. """
+    return con.execute(
+        """SELECT name, MAX(CASE WHEN createDate > hs_after THEN score END),
+                  AVG(CASE WHEN rn <= ? AND createDate > avg_after THEN score END), MAX(createDate)
+           FROM (SELECT f.name, f.hs_after, f.avg_after, t.score, t.createDate,
+                        ROW_NUMBER() OVER (PARTITION BY f.name ORDER BY t.createDate DESC, t.rowid DESC) AS rn
+                 FROM TaskData t JOIN temp.level_filter f ON t.taskName = f.taskName
+                 WHERE t.createDate > date(f.since))
+           GROUP BY name""",
+        [num_runs]).fetchall()
+
+
+def query_runs_since(con: sqlite3.Connection, since: str) -> list:
+    """ (createDate, name, score) of the runs in level_filter played after since. """
+    return con.execute(
+        """SELECT t.createDate, f.name, t.score
+           FROM TaskData t JOIN temp.level_filter f ON t.taskName = f.taskName
+           WHERE t.createDate > date(f.since) AND t.createDate > ?""",
+        [since]).fetchall()
@@ -0,0 +1,151 @@
+import csv
+import os
+import sqlite3
+from threading import Lock
+
+from conf import PROJECT_DIR
+from errors import handle_error
+from fake_sheets import FakeSheetsServer, LastRows, trim_values
+from sheets import (append_rows, create_fake_service, create_service, flatten_values, range_cells,
+                    read_sheet_range, read_sheet_ranges, write_to_cell, write_to_cells)
+
+
+class OutputBackend:
+    """ Where scenario names are read from and highscores/averages/runs are written to. """
+
+    def read_range(self, sheet_id: str, sheet_range: str) -> list:
+        raise NotImplementedError
+
+    def read_ranges(self, sheet_id: str, sheet_ranges: list) -> list:
+        return [self.read_range(sheet_id, r) for r in sheet_ranges]
+
+    def write_cells(self, sheet_id: str, cells: dict) -> None:
+        raise NotImplementedError
+
+    def append_rows(self, sheet_id: str, sheet_range: str, rows: list) -> None:
+        raise NotImplementedError
+
+    def write_cell(self, sheet_id: str, cell: str, val) -> None:
+        self.write_cells(sheet_id, {cell: val})
+
+
+class SheetsBackend(OutputBackend):
+    """ httplib2 is not thread-safe, the update, run log and reconcile threads take turns on the client. """
+
+    def __init__(self, api):
+        self.api = api
+        self.lock = Lock()
+
+    def read_range(self, sheet_id, sheet_range):
+        with self.lock:
+            return read_sheet_range(self.api, sheet_id, sheet_range)
+
+    def read_ranges(self, sheet_id, sheet_ranges):
+        if not sheet_ranges:
+            return []
+        with self.lock:
+            return read_sheet_ranges(self.api, sheet_id, sheet_ranges)
+
+    def write_cell(self, sheet_id, cell, val):
+        with self.lock:
+            write_to_cell(self.api, sheet_id, cell, val)
+
+    def write_cells(self, sheet_id, cells):
+        if len(cells) == 1:
+            self.write_cell(sheet_id, *next(iter(cells.items())))
+        elif cells:
+            with self.lock:
+                write_to_cells(self.api, sheet_id, cells)
+
+    def append_rows(self, sheet_id, sheet_range, rows):
+        with self.lock:
+            append_rows(self.api, sheet_id, sheet_range, rows)
+
+
+class LocalBackend(OutputBackend):
+    """ Keeps a copy of the progress sheet in a local file as (sheet_id, cell, value) entries.
+        Subclasses load and store the cells, everything else works on the in-memory dict. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.cells = self.load()
+        self.last_rows = LastRows(self.cells)
+
+    def load(self) -> dict:
+        raise NotImplementedError
+
+    def store(self, changed: dict) -> None:
+        raise NotImplementedError
+
+    def read_range(self, sheet_id, sheet_range):
+        with self.lock:
+            values = [[self.cells.get((sheet_id, cell), '') for cell in row] for row in range_cells(sheet_range)]
+        return flatten_values(trim_values(values) or [['0']], sheet_range)
+
+    def write_cells(self, sheet_id, cells):
+        with self.lock:
+            self.write_locked(sheet_id, cells)
+
+    def append_rows(self, sheet_id, sheet_range, rows):
+        with self.lock:
+            self.write_locked(sheet_id, self.last_rows.append_cells(sheet_id, sheet_range, rows))
+
+    def write_locked(self, sheet_id, cells):
+        changed = {(sheet_id, cell): str(val) for cell, val in cells.items()}
+        self.cells.update(changed)
+        for cell in cells:
+            self.last_rows.update(sheet_id, cell)
+        self.store(changed)
+
+
+class SqliteBackend(LocalBackend):
+
+    def load(self):
+        self.con = sqlite3.connect(self.path, check_same_thread=False)
+        self.con.execute('CREATE TABLE IF NOT EXISTS cells '
+                         '(sheet_id TEXT, cell TEXT, value TEXT, PRIMARY KEY (sheet_id, cell))')
+        return {(sheet_id, cell): value for sheet_id, cell, value in self.con.execute('SELECT * FROM cells')}
+
+    def store(self, changed):
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?, ?)',
+                                 [(sheet_id, cell, value) for (sheet_id, cell), value in changed.items()])
+
+
+class CsvBackend(LocalBackend):
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, newline='') as csvfile:
+            lines = list(csv.reader(csvfile))
+        cells = {(sheet_id, cell): value for sheet_id, cell, value in lines}  # later lines win
+
+        # Writes are appended, compact cells that were overwritten since the last start
+        if len(cells) < len(lines):
+            with open(self.path, 'w', newline='') as csvfile:
+                csv.writer(csvfile).writerows((sheet_id, cell, value) for (sheet_id, cell), value in cells.items())
+        return cells
+
+    def store(self, changed):
+        with open(self.path, 'a', newline='') as csvfile:
+            csv.writer(csvfile).writerows((sheet_id, cell, value) for (sheet_id, cell), value in changed.items())
+
+
+def create_backend(config: dict) -> OutputBackend:
+    backend = config.get('output_backend', 'sheets')
+    if backend == 'sheets':
+        return SheetsBackend(create_service())
+    elif backend == 'sqlite':
+        return SqliteBackend(os.path.join(PROJECT_DIR, config.get('output_path') or 'progress.sqlite'))
+    elif backend == 'csv':
+        return CsvBackend(os.path.join(PROJECT_DIR, config.get('output_path') or 'progress.csv'))
+    elif backend == 'fake_sheets':
+        server = FakeSheetsServer(latency=config.get('fake_sheets_latency', 0),
+                                  error_rate=config.get('fake_sheets_error_rate', 0),
+                                  seed_file=config.get('output_path'))
+        server.start()
+        return SheetsBackend(create_fake_service(server.url))
+
+    handle_error('output_backend', val=backend)
@@ -0,0 +1,95 @@
+""" Compares the SQL-side Aimlab aggregation with the previous row-by-row Python path
+    on a synthetic TaskData table, plus the run log query that runs next to it when
+    the run log is enabled. Run from the repository root:
+
+    python -m benchmarks.aimlab_query [rows] """
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from aimlab import fill_level_filter, query_runs_since, query_scenario_scores
+
+NUM_TASKS = 60
+NUM_RUNS = 5
+RUN_LOG_WINDOW = 5000  # runlog.RECENT_RUNS, the run log re-reads the runs newer than its floor
+
+
+def create_task_data(path: str, rows: int) -> (dict, dict):
+    rnd = random.Random(0)
+    cs_level_ids = {f'CsLevel.Voltaic.Task{i}': f'task {i}' for i in range(NUM_TASKS)}
+    blacklist = {name: date(2021, 1, 1) + timedelta(days=rnd.randint(0, 400)) for name in cs_level_ids.values()}
+    # Untracked tasks make up a third of the table, like the other Aimlab tasks people play
+    task_names = list(cs_level_ids) + [f'CsLevel.Other.Task{i}' for i in range(NUM_TASKS // 2)]
+
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE TaskData (taskId INTEGER PRIMARY KEY, taskName TEXT, score REAL, createDate TEXT)')
+    start = datetime(2020, 6, 1)
+    step = (datetime(2024, 6, 1) - start) / rows
+    con.executemany('INSERT INTO TaskData (taskName, score, createDate) VALUES (?, ?, ?)',
+                    ((rnd.choice(task_names), rnd.randint(100, 3000) / 3,
+                      (start + step * i).strftime('%Y-%m-%d %H:%M:%S')) for i in range(rows)))
+    con.commit()
+    con.close()
+    return cs_level_ids, blacklist
+
+
+def row_by_row(con: sqlite3.Connection, cs_level_ids: dict, blacklist: dict) -> dict:
+    # The previous update_aimlab: one query per task, max and last N average in Python
+    cur = con.cursor()
+    result = []
+    for csid, name in cs_level_ids.items():
+        cur.execute('SELECT taskName, score FROM TaskData WHERE taskName = ? AND createDate > date(?)',
+                    [csid, str(blacklist[name])])
+        result.extend(cur.fetchall())
+
+    hs = {}
+    recent_scores = {}
+    for task_name, score in result:
+        name = cs_level_ids[task_name]
+        hs[name] = max(hs.get(name, 0), score)
+        runs = recent_scores.setdefault(name, [])
+        runs.append(score)
+        if len(runs) > NUM_RUNS:
+            runs.pop(0)
+
+    return {name: (hs[name], round(sum(runs) / len(runs), 1)) for name, runs in recent_scores.items()}
+
+
+def aggregated(con: sqlite3.Connection, cs_level_ids: dict, blacklist: dict) -> dict:
+    fill_level_filter(con, cs_level_ids, blacklist, set(cs_level_ids.values()))
+    return {name: (hs, round(avg, 1)) for name, hs, avg, _ in query_scenario_scores(con, NUM_RUNS)}
+
+
+def timed(fn, *args, repeat=3) -> (float, dict):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'klutch.bytes')
+        print(f'Creating TaskData with {rows} rows...')
+        cs_level_ids, blacklist = create_task_data(path, rows)
+
+        con = sqlite3.connect(path)
+        old_time, old = timed(row_by_row, con, cs_level_ids, blacklist)
+        new_time, new = timed(aggregated, con, cs_level_ids, blacklist)
+        floor = con.execute('SELECT createDate FROM TaskData ORDER BY rowid DESC LIMIT 1 OFFSET ?',
+                            [RUN_LOG_WINDOW]).fetchone()[0]
+        log_time, runs = timed(query_runs_since, con, floor)
+        con.close()
+
+    print(f'row by row: {old_time * 1000:9.1f} ms')
+    print(f'aggregated: {new_time * 1000:9.1f} ms  ({old_time / new_time:.1f}x)')
+    print(f'run log:    {log_time * 1000:9.1f} ms  ({len(runs)} runs after the floor)')
+    print(f'aggregated + run log: {(new_time + log_time) * 1000:9.1f} ms  ({old_time / (new_time + log_time):.1f}x)')
+    print('results match' if old == new else 'RESULTS DIFFER')
@@ -5,10 +5,12 @@ import sys
 def handle_error(error_type, val=''):
     logging.error({
                       'average': 'An error occured while calculating averages',
+                      'output_backend': f'Unknown output backend: {val}, supported backends are sheets/sqlite/csv/fake_sheets',
                       'no_credentials': 'Follow the setup steps here: https://github.com/VoltaicHQ/Progress-Sheet-Updater',
                       'range': f'Invalid sheet range: {val}',
                       'range_size': 'Range size mismatched, check that each list of ranges in config.json have the same number of cells referenced.',
                       'sheets_api': f'Sheets API error: {val}',
+                      'sqlite_version': f'Aimlab needs SQLite 3.25 or newer, this Python comes with SQLite {val}. Please update Python.',
                       'stats_path': f'Could not find the folder: {val}',
                       'unknown': 'An unknown error occurred.'
                   }.get(error_type, 'unknown'))
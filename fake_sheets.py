@@ -0,0 +1,196 @@
+import argparse
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from sheets import a1_range, col_to_num, num_to_col, range_cells, split_cell
+
+values_path = re.compile(r'^/v4/spreadsheets/(?P<id>[^/]+)/values(?P<rest>.*)$')
+
+
+def trim_values(values: list) -> list:
+    # Mimic the Sheets API, which leaves out trailing blank cells and rows
+    values = [row[:max([i + 1 for i, v in enumerate(row) if v != ''], default=0)] for row in values]
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+
+class LastRows:
+    """ Last used row per (sheet_id, sheet), so appends don't have to look at every stored cell. """
+
+    def __init__(self, cells=()):
+        self.rows = {}
+        for sheet_id, cell in cells:
+            self.update(sheet_id, cell)
+
+    def update(self, sheet_id: str, cell: str) -> None:
+        sheet, _, row = split_cell(cell)
+        if row > self.rows.get((sheet_id, sheet), 0):
+            self.rows[(sheet_id, sheet)] = row
+
+    def append_cells(self, sheet_id: str, sheet_range: str, rows: list) -> dict:
+        """ New cells for rows appended below the last used row of the range's sheet. """
+        m = a1_range.match(sheet_range)
+        sheet, col1 = m.group('sheet'), col_to_num(m.group('col1'))
+        last_row = self.rows.get((sheet_id, sheet), 0)
+        return {f'{sheet}!{num_to_col(col1 + c)}{last_row + 1 + r}': val
+                for r, row in enumerate(rows) for c, val in enumerate(row)}
+
+
+class FakeSheetsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def log_message(self, format, *args):
+        logging.debug('Fake Sheets: ' + format, *args)
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self):
+        server = self.server
+        url = urlsplit(self.path)
+        m = values_path.match(url.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.draw() < server.error_rate:
+            server.count('429')
+            return self.send_json(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED',
+                                                  'message': 'Quota exceeded (fake_sheets)'}})
+        if not m:
+            return self.send_json(404, {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': self.path}})
+
+        sheet_id, rest, query = m.group('id'), m.group('rest'), parse_qs(url.query)
+        if rest == ':batchGet' and self.command == 'GET':
+            server.count('batchGet')
+            return self.send_json(200, {'spreadsheetId': sheet_id,
+                                        'valueRanges': [server.get(sheet_id, r) for r in query.get('ranges', [])]})
+        if rest == ':batchUpdate' and self.command == 'POST':
+            server.count('batchUpdate')
+            cells = {}
+            for data in body.get('data', []):
+                cells.update(server.put(sheet_id, data['range'], data.get('values', [])))
+            return self.send_json(200, {'spreadsheetId': sheet_id, 'totalUpdatedCells': len(cells)})
+
+        sheet_range, _, action = rest[1:].partition(':')
+        sheet_range = unquote(sheet_range)
+        if not action and self.command == 'GET':
+            server.count('get')
+            return self.send_json(200, server.get(sheet_id, sheet_range))
+        if not action and self.command == 'PUT':
+            server.count('update')
+            cells = server.put(sheet_id, sheet_range, body.get('values', []))
+            return self.send_json(200, {'spreadsheetId': sheet_id, 'updatedRange': sheet_range,
+                                        'updatedCells': len(cells)})
+        if action == 'append' and self.command == 'POST':
+            server.count('append')
+            cells = server.append(sheet_id, sheet_range, body.get('values', []))
+            return self.send_json(200, {'spreadsheetId': sheet_id, 'tableRange': sheet_range,
+                                        'updates': {'updatedRows': len(body.get('values', [])),
+                                                    'updatedCells': len(cells)}})
+
+        self.send_json(400, {'error': {'code': 400, 'status': 'INVALID_ARGUMENT', 'message': self.path}})
+
+
+class FakeSheetsServer(ThreadingHTTPServer):
+    """ In-process stand-in for the Sheets API values.get/batchGet/update/batchUpdate/append
+        endpoints, for offline runs and load tests. Every response is delayed by latency
+        seconds and a share of error_rate requests fail with 429. Cells can be seeded from
+        a JSON file of the form {"sheet_id": {"Sheet!A1": "value", ...}}. """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, seed_file=None, random_seed=0):
+        super().__init__((host, port), FakeSheetsHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(random_seed)  # reproducible 429s
+        self.requests = Counter()
+        self.lock = Lock()
+        self.cells = {}
+        if seed_file:
+            with open(seed_file, 'r') as file:
+                self.cells = {(sheet_id, cell): str(val)
+                              for sheet_id, cells in json.load(file).items() for cell, val in cells.items()}
+        self.last_rows = LastRows(self.cells)
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/'
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def draw(self) -> float:
+        # Handler threads share the generator, draw under the lock so the 429 sequence is reproducible
+        with self.lock:
+            return self.random.random()
+
+    def count(self, request: str) -> None:
+        with self.lock:
+            self.requests[request] += 1
+
+    def get(self, sheet_id, sheet_range):
+        with self.lock:
+            values = [[self.cells.get((sheet_id, cell), '') for cell in row] for row in range_cells(sheet_range)]
+        response = {'range': sheet_range, 'majorDimension': 'ROWS'}
+        values = trim_values(values)
+        if values:
+            response['values'] = values
+        return response
+
+    def put(self, sheet_id, sheet_range, values):
+        cells = {cell: val for row, row_values in zip(range_cells(sheet_range), values)
+                 for cell, val in zip(row, row_values)}
+        with self.lock:
+            self.store(sheet_id, cells)
+        return cells
+
+    def append(self, sheet_id, sheet_range, values):
+        with self.lock:
+            cells = self.last_rows.append_cells(sheet_id, sheet_range, values)
+            self.store(sheet_id, cells)
+        return cells
+
+    def store(self, sheet_id, cells):
+        for cell, val in cells.items():
+            self.cells[(sheet_id, cell)] = str(val)
+            self.last_rows.update(sheet_id, cell)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a fake Google Sheets API for offline runs and load tests.')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--seed', help='JSON file with the initial cell values')
+    args = parser.parse_args()
+
+    server = FakeSheetsServer(port=args.port, latency=args.latency, error_rate=args.error_rate, seed_file=args.seed)
+    print(f'Serving fake Sheets API on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(server.requests))
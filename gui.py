@@ -42,6 +42,8 @@ class Gui:
             self.run_mode.set(self.config["run_mode"])
             self.run_mode_options = ["once",
                                      "watchdog",
+                                     "polling",
+                                     "polling_observer",
                                      "interval"]
             self.game.set(self.config["game"])
             self.game_options = ["Aimlab",
@@ -1,4 +1,3 @@
-import csv
 import json
 import logging
 import logging.config
@@ -9,15 +8,20 @@ import time
 import urllib.request
 from dataclasses import dataclass, field
 from datetime import datetime
-from threading import Timer
+from threading import Lock, Timer
 
-import googleapiclient.discovery
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 
+from aimlab import MIN_SQLITE_VERSION, fill_level_filter, query_runs_since, query_scenario_scores
+from backends import OutputBackend, create_backend
 from errors import handle_error
 from gui import Gui
-from sheets import create_service, read_sheet_range, validate_sheet_range, write_to_cell
+from runlog import RunLog
+from scanner import StatsScanner
+from sheets import validate_sheet_range
+from stats import read_run_from_file
 from conf import AIMLAB_DB_PATH
 
 
@@ -29,6 +33,11 @@ class Scenario:
     avg: float = 0
     recent_scores: list = field(default_factory=list)
     ids: list = field(default_factory=list)
+    written_hs: float = 0  # last values known to be on the sheet, to tell manual edits apart
+    written_avg: float = 0
+    hs_since: str = ''  # Aimlab: after a manual edit was adopted only runs newer than this count
+    avg_since: str = ''
+    newest_run: str = ''  # Aimlab: createDate of the newest run the last update saw
 
 
 def cells_from_sheet_ranges(ranges: str):
@@ -44,7 +53,7 @@ def cells_from_sheet_ranges(ranges: str):
             handle_error('range', val=r)
 
 
-def init_scenario_data_kovaaks(config: dict, sheet_api: googleapiclient.discovery.Resource) -> dict:
+def init_scenario_data_kovaaks(config: dict, output: OutputBackend) -> dict:
     hs_cells_iter = cells_from_sheet_ranges(config['highscore_ranges'])
     if config["calculate_averages"]:
         avg_cells_iter = cells_from_sheet_ranges(config['average_ranges'])
@@ -53,7 +62,7 @@ def init_scenario_data_kovaaks(config: dict, sheet_api: googleapiclient.discover
 
     i = 0
     for r in config['scenario_name_ranges']:
-        for s in read_sheet_range(sheet_api, config["sheet_id_kovaaks"], r):
+        for s in output.read_range(config["sheet_id_kovaaks"], r):
             if s not in scens:
                 scens[s] = Scenario()
 
@@ -68,25 +77,25 @@ def init_scenario_data_kovaaks(config: dict, sheet_api: googleapiclient.discover
 
     highscores = []
     for r in config['highscore_ranges']:
-        highscores += map(lambda x: float(x), read_sheet_range(sheet_api, config["sheet_id_kovaaks"], r))
+        highscores += map(lambda x: float(x), output.read_range(config["sheet_id_kovaaks"], r))
 
     if config["calculate_averages"]:
         averages = []
         for r in config['average_ranges']:
-            averages += map(lambda x: float(x), read_sheet_range(sheet_api, config["sheet_id_kovaaks"], r))
+            averages += map(lambda x: float(x), output.read_range(config["sheet_id_kovaaks"], r))
 
     if len(highscores) < len(scens):  # Require highscore cells but not averages
         handle_error('range_size')
 
     for s in scens:
-        scens[s].hs = min([highscores[i] for i in scens[s].ids])
+        scens[s].hs = scens[s].written_hs = min([highscores[i] for i in scens[s].ids])
         if config["calculate_averages"]:
-            scens[s].avg = min([averages[i] for i in scens[s].ids])
+            scens[s].avg = scens[s].written_avg = min([averages[i] for i in scens[s].ids])
 
     return scens
 
 
-def init_scenario_data_aimlab(config: dict, sheet_api: googleapiclient.discovery.Resource) -> dict:
+def init_scenario_data_aimlab(config: dict, output: OutputBackend) -> dict:
     hs_cells_iter = cells_from_sheet_ranges(config['aimlab_score_ranges'])
     avg_cells_iter = cells_from_sheet_ranges(config['aimlab_average_ranges'])
 
@@ -94,7 +103,7 @@ def init_scenario_data_aimlab(config: dict, sheet_api: googleapiclient.discovery
 
     i = 0
     for r in config['aimlab_name_ranges']:
-        for s in read_sheet_range(sheet_api, config["sheet_id_aimlab"], r):
+        for s in output.read_range(config["sheet_id_aimlab"], r):
             if s not in scens:
                 scens[s] = Scenario()
 
@@ -105,74 +114,65 @@ def init_scenario_data_aimlab(config: dict, sheet_api: googleapiclient.discovery
 
     highscores = []
     for r in config['aimlab_score_ranges']:
-        highscores += map(lambda x: float(x), read_sheet_range(sheet_api, config["sheet_id_aimlab"], r))
+        highscores += map(lambda x: float(x), output.read_range(config["sheet_id_aimlab"], r))
 
     averages = []
     for r in config['aimlab_average_ranges']:
-        averages += map(lambda x: float(x), read_sheet_range(sheet_api, config["sheet_id_aimlab"], r))
+        averages += map(lambda x: float(x), output.read_range(config["sheet_id_aimlab"], r))
 
     if len(highscores) < len(scens):  # Require highscore cells but not averages
         handle_error('range_size')
 
     for s in scens:
-        scens[s].hs = min([highscores[i] for i in scens[s].ids])
-        scens[s].avg = min([averages[i] for i in scens[s].ids])
+        scens[s].hs = scens[s].written_hs = min([highscores[i] for i in scens[s].ids])
+        scens[s].avg = scens[s].written_avg = min([averages[i] for i in scens[s].ids])
 
     return scens
 
 
 def read_score_from_file(file_path: str) -> float:
-    with open(file_path, newline='') as csvfile:
-        for row in csv.reader(csvfile):
-            if row and row[0] == 'Score:':
-                return round(float(row[1]), 1)
-    return 0.0
+    return read_run_from_file(file_path).score
 
 
-def update_aimlab(config: dict, scens: dict, cs_level_ids: dict, blacklist: dict) -> None:
+def kovaaks_run_time(file_name: str) -> str:
+    # Stats files are named '<scenario> - Challenge - YYYY.MM.DD-HH.MM.SS Stats.csv'
+    stamp = file_name[file_name.find(" - Challenge - ") + 15:].split(" ")[0]
+    return datetime.strptime(stamp, "%Y.%m.%d-%H.%M.%S").strftime("%Y-%m-%d %H:%M:%S")
+
+
+def update_aimlab(config: dict, scens: dict, cs_level_ids: dict, blacklist: dict, run_log: RunLog = None) -> None:
     new_hs = set()
     new_avgs = set()
 
     # Open db connection
     con = sqlite3.connect(AIMLAB_DB_PATH)
-    cur = con.cursor()
-
-    # Get scores from the database
-    result = []
-    for csid, name in cs_level_ids.items():
-        cur.execute(
-            f"SELECT taskName, score FROM TaskData WHERE taskName = ? AND createDate > date(?)",
-            [csid, blacklist[name]])
-        temp = cur.fetchall()
-        result.extend(temp)
-
-    for s in result:
-        name = cs_level_ids[s[0]]
-        score = s[1]
-        if score > scens[name].hs:
-            scens[name].hs = score
+    fill_level_filter(con, cs_level_ids, blacklist, scens, {s: (scens[s].hs_since, scens[s].avg_since) for s in scens})
+
+    # Highscores and last N averages are aggregated by SQLite, one row per played scenario
+    for name, hs, avg, newest_run in query_scenario_scores(con, config['num_of_runs_to_average']):
+        scens[name].newest_run = newest_run
+        if hs is not None and hs > scens[name].hs:
+            scens[name].hs = hs
             new_hs.add(name)
 
-        if config['calculate_averages']:
-            scens[name].recent_scores.append(score)  # Will be last N runs if files are fed chronologically
-            if len(scens[name].recent_scores) > config['num_of_runs_to_average']:
-                scens[name].recent_scores.pop(0)
+        if config['calculate_averages'] and avg is not None:
+            new_avg = round(avg, 1)
+            if new_avg != scens[name].avg:
+                scens[name].avg = new_avg
+                new_avgs.add(name)
 
-    if config['calculate_averages']:
-        for s in scens:
-            runs = scens[s].recent_scores
-            if runs:  # If the scenario was never played this would result in a div by zero error
-                new_avg = round(sum(runs) / len(runs), 1)
-            if runs and new_avg != scens[s].avg:
-                scens[s].avg = new_avg
-                new_avgs.add(s)
+    if run_log:
+        run_log.add_runs([(str(date), name, score) for date, name, score in query_runs_since(con, run_log.floor)])
+
+    con.close()
 
     create_output(new_hs, new_avgs, scens, config["sheet_id_aimlab"])  # check averages here as well
 
 
-def update_kovaaks(config: dict, scens: dict, files: list, blacklist: dict) -> None:
+def update_kovaaks(config: dict, scens: dict, files: list, blacklist: dict, run_log: RunLog = None) -> None:
     new_hs = set()
     new_avgs = set()
+    runs_played = []
 
     # Process new runs to populate new_hs and new_avgs
     for f in files:
@@ -185,6 +185,8 @@ def update_kovaaks(config: dict, scens: dict, files: list, blacklist: dict) -> N
                 if playdate <= blacklist[s]:
                     continue
             score = read_score_from_file(f'{config["stats_path"]}/{f}')
+            if run_log:
+                runs_played.append((kovaaks_run_time(f), f[0:f.find(" - Challenge - ")], score))
             if score > scens[s].hs:
                 scens[s].hs = score
                 new_hs.add(s)
@@ -203,6 +205,9 @@ def update_kovaaks(config: dict, scens: dict, files: list, blacklist: dict) -> N
                 scens[s].avg = new_avg
                 new_avgs.add(s)
 
+    if run_log:
+        run_log.add_runs(runs_played)
+
     create_output(new_hs, new_avgs, scens, config["sheet_id_kovaaks"])
 
 
@@ -212,19 +217,77 @@ def create_output(new_hs: dict, new_avgs: dict, scens: dict, sheet_id: str) -> N
         logging.info('Your progress sheet is up-to-date.')
         return
 
+    cells = {}
     if new_hs:
         logging.info(f'New Highscore{"s" if len(new_hs) > 1 else ""}')
         for s in new_hs:
             logging.info(f'{scens[s].hs:>10} - {s}')
             for cell in scens[s].hs_cells:
-                write_to_cell(sheet_api, sheet_id, cell, scens[s].hs)
+                cells[cell] = scens[s].hs
+            scens[s].written_hs = scens[s].hs
 
     if new_avgs:
         logging.info(f' New Average{"s" if len(new_hs) > 1 else ""}')
         for s in new_avgs:
             logging.info(f'{scens[s].avg:>10} - {s}')
             for cell in scens[s].avg_cells:
-                write_to_cell(sheet_api, sheet_id, cell, scens[s].avg)
+                cells[cell] = scens[s].avg
+            scens[s].written_avg = scens[s].avg
+
+    output.write_cells(sheet_id, cells)  # one batched request for all changed cells
+
+
+def reconcile_scenarios(config: dict, scens: dict, sheet_id: str, hs_ranges: list, avg_ranges: list) -> (set, set):
+    # Pick up highscores/averages that were edited by hand since they were last written, in one batched read
+    values = output.read_ranges(sheet_id, hs_ranges + avg_ranges)
+    try:
+        highscores = [float(x) for vals in values[:len(hs_ranges)] for x in vals]
+        averages = [float(x) for vals in values[len(hs_ranges):] for x in vals]
+    except ValueError as err:
+        logging.warning(f'Skipping sheet reconciliation, found a non-numeric score: {err}')
+        return set(), set()
+
+    # 'highest' keeps a higher local value over a lower manual edit, 'sheet' always takes the edit
+    keep_higher = config.get('reconcile_policy', 'highest') == 'highest'
+    new_hs = set()
+    new_avgs = set()
+    adopted_hs = set()
+    adopted_avgs = set()
+    for s in scens:
+        sheet_hs = min([highscores[i] for i in scens[s].ids])
+        if sheet_hs != scens[s].written_hs:
+            if keep_higher and scens[s].hs > sheet_hs:
+                new_hs.add(s)
+            else:
+                logging.info(f'Highscore of {s} was changed on the sheet: {scens[s].hs} -> {sheet_hs}')
+                scens[s].hs = scens[s].written_hs = sheet_hs
+                adopted_hs.add(s)
+
+        if averages and scens[s].avg_cells:
+            sheet_avg = min([averages[i] for i in scens[s].ids])
+            if sheet_avg != scens[s].written_avg:
+                if keep_higher and scens[s].avg > sheet_avg:
+                    new_avgs.add(s)
+                else:
+                    logging.info(f'Average of {s} was changed on the sheet: {scens[s].avg} -> {sheet_avg}')
+                    scens[s].avg = scens[s].written_avg = sheet_avg
+                    scens[s].recent_scores.clear()  # Kovaaks: average only the runs played after the edit
+                    adopted_avgs.add(s)
+
+    if new_hs or new_avgs:
+        logging.info('Restoring scores that were lowered on the sheet')
+        create_output(new_hs, new_avgs, scens, sheet_id)
+
+    return adopted_hs, adopted_avgs
+
+
+def pin_aimlab_scenarios(scens: dict, adopted_hs: set, adopted_avgs: set) -> None:
+    # update_aimlab aggregates over the whole database and would overwrite adopted edits, only count newer runs.
+    # Runs played since the last update are newer than newest_run and still count.
+    for s in adopted_hs:
+        scens[s].hs_since = scens[s].newest_run
+    for s in adopted_avgs:
+        scens[s].avg_since = scens[s].newest_run
 
 
 def init_version_blacklist() -> dict:
@@ -269,6 +332,10 @@ class LambdaDispatchEventHandler(FileSystemEventHandler):
         elif event.event_type == 'modified':
             if config["game"] == "Kovaaks" or event.src_path.endswith("klutch.bytes"):
                 self.func()
+        elif event.event_type in ('created', 'moved'):
+            # PollingObserver only reports a new stats file as created, synced folders may move it in place
+            if config["game"] == "Kovaaks":
+                self.func()
 
 
 def debounce(wait):
@@ -296,19 +363,38 @@ def debounce(wait):
 
 @debounce(5)
 def process_files_kovaaks():
-    global config, sheet_api, blacklist, scenarios, stats
+    global config, output, blacklist, scenarios, scanner, run_log, state_lock
+
+    with state_lock:
+        update_kovaaks(config, scenarios, scanner.scan(), blacklist, run_log)
+        pending = bool(scanner.pending)
 
-    new_stats = os.listdir(config['stats_path'])
-    unprocessed = list(sorted([f for f in new_stats if f not in stats]))
-    update_kovaaks(config, scenarios, unprocessed, blacklist)
-    stats = new_stats
+    if pending:  # Files still being written send no further events, check them again once they settled
+        process_files_kovaaks()
 
 
 @debounce(5)
 def process_files_aimlab():
-    global config, sheet_api, scenarios, cs_level_ids, blacklist
+    global config, output, scenarios, cs_level_ids, blacklist, run_log, state_lock
 
-    update_aimlab(config, scenarios, cs_level_ids, blacklist)
+    with state_lock:
+        update_aimlab(config, scenarios, cs_level_ids, blacklist, run_log)
+
+
+def reconcile_periodically():
+    global config, output, scenarios, reconcile_ranges, state_lock
+
+    try:
+        with state_lock:
+            adopted_hs, adopted_avgs = reconcile_scenarios(config, scenarios, *reconcile_ranges)
+            if config["game"] == "Aimlab" and (adopted_hs or adopted_avgs):
+                pin_aimlab_scenarios(scenarios, adopted_hs, adopted_avgs)
+    except (Exception, SystemExit):  # handle_error exits, but only this timer thread
+        logging.exception('Sheet reconciliation failed, trying again at the next check')
+    finally:
+        t = Timer(max(config['reconcile_interval'], 60), reconcile_periodically)
+        t.daemon = True
+        t.start()
 
 
 def handle_exception(exc_type, exc_value, exc_traceback):
@@ -343,36 +429,62 @@ if __name__ == "__main__":
         logging.debug(json.dumps(config, indent=2))
         handle_error('no_credentials')
 
-    logging.debug("Creating service...")
-    sheet_api = create_service()
+    logging.debug("Creating output backend...")
+    output = create_backend(config)
+    state_lock = Lock()  # scenario state is shared by the file processing and reconciliation timers
+
+    run_log = None
+    if config.get('run_log_range'):
+        run_log = RunLog(output,
+                         config["sheet_id_kovaaks"] if config["game"] == "Kovaaks" else config["sheet_id_aimlab"],
+                         config['run_log_range'], config["game"],
+                         batch_size=config.get('run_log_batch_size', 500),
+                         flush_interval=config.get('run_log_flush_interval', 30))
 
     # Aimlab has its data in /AppData/LocalLow/statespace/aimlab_tb/klutch.bytes
     if config["game"] == "Aimlab":
         logging.debug("Game: Aimlab")
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            handle_error('sqlite_version', val=sqlite3.sqlite_version)
         logging.debug("Initializing scenario data...")
-        scenarios = init_scenario_data_aimlab(config, sheet_api)
+        scenarios = init_scenario_data_aimlab(config, output)
         logging.debug("Initializing CsLevelIds...")
         cs_level_ids, blacklist = init_cs_level_ids_and_blacklist()
-        update_aimlab(config, scenarios, cs_level_ids, blacklist)
+        reconcile_ranges = (config["sheet_id_aimlab"], config['aimlab_score_ranges'], config['aimlab_average_ranges'])
+        update_aimlab(config, scenarios, cs_level_ids, blacklist, run_log)
 
     # Kovaaks has its data in the stats folder
     elif config["game"] == "Kovaaks":
         logging.debug("Game: Kovaaks")
         logging.debug("Initializing scenario data...")
-        scenarios = init_scenario_data_kovaaks(config, sheet_api)
+        scenarios = init_scenario_data_kovaaks(config, output)
         logging.debug("Initializing version blacklist...")
         blacklist = init_version_blacklist()
+        reconcile_ranges = (config["sheet_id_kovaaks"], config['highscore_ranges'],
+                            config['average_ranges'] if config["calculate_averages"] else [])
+
+        if not os.path.isdir(config['stats_path']):
+            handle_error('stats_path', val=config['stats_path'])
+        scanner = StatsScanner(config['stats_path'])
 
-        stats = list(sorted(os.listdir(config['stats_path'])))
+        update_kovaaks(config, scenarios, scanner.scan(), blacklist, run_log)
 
-        update_kovaaks(config, scenarios, stats, blacklist)
+    if config['run_mode'] != 'once' and config.get('reconcile_interval'):
+        reconcile_timer = Timer(max(config['reconcile_interval'], 60), reconcile_periodically)
+        reconcile_timer.daemon = True
+        reconcile_timer.start()
 
     if config['run_mode'] == 'once':
+        if run_log:
+            run_log.flush()
         logging.info("Finished Updating, program will close in 3 seconds...")
         time.sleep(3)
         sys.exit()
-    elif config['run_mode'] == 'watchdog':
-        observer = Observer()
+    elif config['run_mode'] in ('watchdog', 'polling_observer'):
+        if config['run_mode'] == 'watchdog':
+            observer = Observer()
+        else:  # Fallback for network drives, lists and stats every file on each check
+            observer = PollingObserver(timeout=max(config['polling_interval'], 1))
         if config["game"] == "Kovaaks":
             event_handler = LambdaDispatchEventHandler(lambda: process_files_kovaaks())
             observer.schedule(event_handler, config['stats_path'])
@@ -386,20 +498,29 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             observer.stop()
         observer.join()
-    elif config['run_mode'] == 'interval':
+    elif config['run_mode'] in ('polling', 'interval'):
+        # polling is meant for network drives or synced folders that don't emit file system events. The scanner
+        # only lists the stats folder when its mtime changed, so it can check more often than interval.
+        polling = config['run_mode'] == 'polling'
+        db_mtime = os.stat(AIMLAB_DB_PATH).st_mtime if config["game"] == "Aimlab" else None
         while True:
             if config["game"] == "Kovaaks":
                 process_files_kovaaks()
             elif config["game"] == "Aimlab":
-                process_files_aimlab()
+                db_mtime, last_db_mtime = os.stat(AIMLAB_DB_PATH).st_mtime, db_mtime
+                if not polling or db_mtime != last_db_mtime:
+                    process_files_aimlab()
             try:
-                time.sleep(max(config['polling_interval'], 30))
+                time.sleep(max(config['polling_interval'], 10 if polling else 30))
             except KeyboardInterrupt:
                 logging.debug('Received keyboard interrupt.')
                 break
     else:
-        logging.info("Run mode is not supported. Supported types are 'once'/'watchdog'/'interval'.")
+        logging.info("Run mode is not supported. "
+                     "Supported types are 'once'/'watchdog'/'polling'/'polling_observer'/'interval'.")
 
+    if run_log:
+        run_log.flush()
     logging.info("Program will close in 3 seconds...")
     time.sleep(3)
     sys.exit()
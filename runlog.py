@@ -0,0 +1,105 @@
+import json
+import logging
+from threading import Lock, Timer
+
+from helpers import open_project_file
+
+RUN_LOG_STATE_FILE = 'run_log_state.json'
+RECENT_RUNS = 5000  # exported runs remembered for deduplication, older runs are not exported anymore
+
+
+class RunLog:
+    """ Buffers processed runs and appends them to a sheet tab in batches.
+
+        Timestamps are sortable strings ('YYYY-MM-DD HH:MM:SS'). The last RECENT_RUNS
+        exported (timestamp, scenario) pairs per game are saved to run_log_state.json, so
+        restarts, repeated reads and runs arriving out of order never append a row twice.
+        Runs older than that window (the floor) are skipped. """
+
+    def __init__(self, output, sheet_id: str, sheet_range: str, game: str, batch_size: int = 500,
+                 flush_interval: float = 30):
+        self.output = output
+        self.sheet_id = sheet_id
+        self.sheet_range = sheet_range
+        self.game = game
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.lock = Lock()
+        self.timer = None
+
+        self.state = self.load_state()
+        game_state = self.state.get(game, {})
+        if isinstance(game_state, str):  # older state files only kept the newest exported timestamp
+            game_state = {'floor': game_state}
+        self.floor = game_state.get('floor', '')
+        self.recent = [tuple(key) for key in game_state.get('recent', [])]
+        self.known = set(self.recent)  # exported and buffered runs
+        self.replayed = False
+
+    @staticmethod
+    def load_state() -> dict:
+        try:
+            with open_project_file(RUN_LOG_STATE_FILE, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def add_runs(self, runs: list) -> None:
+        """ Queue (timestamp, scenario, score) tuples from one update, in any order. """
+        with self.lock:
+            new = []
+            late = 0
+            for r in runs:
+                if (r[0], r[1]) in self.known:
+                    continue
+                if r[0] <= self.floor:
+                    late += 1
+                    continue
+                new.append(r)
+                self.known.add((r[0], r[1]))
+
+            if late:
+                # Expected for old runs when the backlog is replayed at startup, not afterwards
+                (logging.warning if self.replayed else logging.debug)(
+                    f'Not exporting {late} run{"s" if late > 1 else ""} from before {self.floor} to the run log')
+            self.replayed = True
+            if not new:
+                return
+            self.rows.extend([timestamp, scenario, score, self.game] for timestamp, scenario, score in new)
+            full = len(self.rows) >= self.batch_size
+            if not full and self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.rows:
+                return
+
+            self.rows.sort()
+            while self.rows:
+                # Book every batch as soon as it is appended, so a later failing batch can't resend it
+                batch = self.rows[:self.batch_size]
+                self.output.append_rows(self.sheet_id, self.sheet_range, batch)
+                del self.rows[:len(batch)]
+                self.mark_exported(batch)
+                logging.debug(f'Exported {len(batch)} run{"s" if len(batch) > 1 else ""} to {self.sheet_range}')
+
+    def mark_exported(self, rows: list) -> None:
+        self.recent = sorted(self.recent + [(row[0], row[1]) for row in rows])
+        if len(self.recent) > RECENT_RUNS:
+            forgotten = self.recent[:-RECENT_RUNS]
+            self.recent = self.recent[-RECENT_RUNS:]
+            self.floor = max(self.floor, forgotten[-1][0])
+            self.known.difference_update(forgotten)
+        self.state[self.game] = {'floor': self.floor, 'recent': self.recent}
+        with open_project_file(RUN_LOG_STATE_FILE, 'w') as file:
+            json.dump(self.state, file, indent=2)
@@ -0,0 +1,46 @@
+import os
+import time
+
+
+class StatsScanner:
+    """ Incremental poller for the stats folder. Skips the listing entirely while
+        the folder's mtime is unchanged and only reports files once they have
+        stopped growing, which works on network shares where no file system
+        events arrive. """
+
+    def __init__(self, path: str, settle_time: float = 2.0):
+        self.path = path
+        self.settle_time = settle_time
+        self.seen = set()
+        self.pending = {}  # name -> (mtime, size) of files that may still be written to
+        self.dir_mtime = None
+        self.scanned_at = 0.0
+
+    def scan(self) -> list:
+        """ Return the names of new, fully written files in chronological file name order. """
+        now = time.time()
+        dir_mtime = os.stat(self.path).st_mtime
+        # A file still being written does not touch the folder mtime, so keep polling until it settles.
+        # Only trust an unchanged mtime if the last listing was clearly later, as coarse (FAT, SMB)
+        # timestamps don't change for a file created in the same tick as that listing.
+        if dir_mtime == self.dir_mtime and not self.pending and self.scanned_at - dir_mtime > self.settle_time:
+            return []
+        self.dir_mtime = dir_mtime
+        self.scanned_at = now
+
+        ready = []
+        pending = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name in self.seen or not entry.name.endswith('.csv'):
+                    continue
+                st = entry.stat()  # cached by scandir on Windows, a single stat elsewhere
+                state = (st.st_mtime, st.st_size)
+                if st.st_size and (self.pending.get(entry.name) == state or now - st.st_mtime >= self.settle_time):
+                    ready.append(entry.name)
+                else:
+                    pending[entry.name] = state
+
+        self.pending = pending
+        self.seen.update(ready)
+        return sorted(ready)
@@ -1,7 +1,9 @@
 import os.path
 import pickle
 import re
+import time
 
+from google.auth.credentials import AnonymousCredentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
@@ -11,30 +13,86 @@ from google.auth.exceptions import RefreshError
 from conf import SPREADSHEET_CREDENTIALS_FILE_PATH, SPREADSHEET_TOKEN_FILE_PATH
 from errors import handle_error
 
+# Requests are retried with exponential backoff on 429 and 5xx responses
+NUM_RETRIES = 5
+
 
 def validate_sheet_range(str):
     valid_range = re.compile(r'(?P<sheet>.+)!(?P<col1>[A-Z]+)(?P<row1>\d+)(:(?P<col2>[A-Z]+)(?P<row2>\d+))?')
     return valid_range.match(str)
 
 
+# Like validate_sheet_range, but rows are optional so whole columns ('Runs!A:D') match too
+a1_range = re.compile(r'(?P<sheet>.+)!(?P<col1>[A-Z]+)(?P<row1>\d*)(:(?P<col2>[A-Z]+)(?P<row2>\d*))?$')
+
+
+def col_to_num(col: str) -> int:
+    num = 0
+    for c in col:
+        num = num * 26 + ord(c) - ord('A') + 1
+    return num
+
+
+def num_to_col(num: int) -> str:
+    col = ''
+    while num:
+        num, rem = divmod(num - 1, 26)
+        col = chr(ord('A') + rem) + col
+    return col
+
+
+def split_cell(cell: str) -> (str, int, int):
+    m = a1_range.match(cell)
+    return m.group('sheet'), col_to_num(m.group('col1')), int(m.group('row1'))
+
+
+def range_cells(sheet_range: str) -> list:
+    """ Rows of cell names covered by a bounded range, e.g. 'S!A1:B2' -> [['S!A1', 'S!B1'], ['S!A2', 'S!B2']] """
+    m = a1_range.match(sheet_range)
+    col1 = col_to_num(m.group('col1'))
+    col2 = col_to_num(m.group('col2') or m.group('col1'))
+    row1 = int(m.group('row1'))
+    row2 = int(m.group('row2') or m.group('row1'))
+    return [[f'{m.group("sheet")}!{num_to_col(c)}{r}' for c in range(col1, col2 + 1)]
+            for r in range(row1, row2 + 1)]
+
+
+def flatten_values(values, sheet_range):
+    # responses trim blank cells, act as if they are 0-filled
+    m = validate_sheet_range(sheet_range)
+    length = int(m.group('row2')) - int(m.group('row1')) + 1
+    for lst in values:
+        if len(lst) < 1:
+            lst.append('0')
+    flat = [str(val).strip().lower() for row in values for val in row]
+    while len(flat) < length:
+        flat.append('0')
+
+    return flat
+
+
 def read_sheet_range(api, id, sheet_range):
     try:
         response = (api.values()
-                    .get(spreadsheetId=id, range=sheet_range)
-                    .execute()
+                    .get(spreadsheetId=id, range=sheet_range, valueRenderOption='UNFORMATTED_VALUE')
+                    .execute(num_retries=NUM_RETRIES)
                     .get('values', [['0']]))
 
-        # responses trim blank cells, act as if they are 0-filled
-        m = validate_sheet_range(sheet_range)
-        length = int(m.group('row2')) - int(m.group('row1')) + 1
-        for lst in response:
-            if len(lst) < 1:
-                lst.append('0')
-        flat = [val.strip().lower() for row in response for val in row]
-        while len(flat) < length:
-            flat.append('0')
+        return flatten_values(response, sheet_range)
+
+    except HttpError as error:
+        handle_error('sheets_api', val=error._get_reason())
+
+
+def read_sheet_ranges(api, id, sheet_ranges):
+    try:
+        response = (api.values()
+                    .batchGet(spreadsheetId=id, ranges=sheet_ranges, valueRenderOption='UNFORMATTED_VALUE')
+                    .execute(num_retries=NUM_RETRIES)
+                    .get('valueRanges', []))
 
-        return flat
+        return [flatten_values(value_range.get('values', [['0']]), sheet_range)
+                for value_range, sheet_range in zip(response, sheet_ranges)]
 
     except HttpError as error:
         handle_error('sheets_api', val=error._get_reason())
@@ -45,11 +103,38 @@ def write_to_cell(api, id, cell, val):
         api.values().update(spreadsheetId=id,
                             range=cell,
                             valueInputOption='RAW',
-                            body={'values': [[val]]}).execute()
+                            body={'values': [[val]]}).execute(num_retries=NUM_RETRIES)
     except HttpError as error:
         handle_error('sheets_api', val=error._get_reason())
 
 
+def write_to_cells(api, id, cells):
+    try:
+        api.values().batchUpdate(spreadsheetId=id,
+                                 body={'valueInputOption': 'RAW',
+                                       'data': [{'range': cell, 'values': [[val]]} for cell, val in cells.items()]}
+                                 ).execute(num_retries=NUM_RETRIES)
+    except HttpError as error:
+        handle_error('sheets_api', val=error._get_reason())
+
+
+def append_rows(api, id, sheet_range, rows):
+    # values.append is not idempotent, a 5xx may have appended already. Only a 429 is safe to resend.
+    request = api.values().append(spreadsheetId=id,
+                                  range=sheet_range,
+                                  valueInputOption='RAW',
+                                  insertDataOption='INSERT_ROWS',
+                                  body={'values': rows})
+    for retry in range(NUM_RETRIES + 1):
+        try:
+            request.execute()
+            return
+        except HttpError as error:
+            if error.resp.status != 429 or retry == NUM_RETRIES:
+                handle_error('sheets_api', val=error._get_reason())
+            time.sleep(2 ** retry)
+
+
 # https://developers.google.com/sheets/api/quickstart/python
 def create_service():
     if not os.path.exists(SPREADSHEET_CREDENTIALS_FILE_PATH):
@@ -87,3 +172,10 @@ def create_service():
         return service.spreadsheets()
     except HttpError as error:
         handle_error('sheets_api', val=error._get_reason())
+
+
+def create_fake_service(url):
+    # Talks to a fake_sheets.FakeSheetsServer instead of Google, no credentials needed
+    service = build('sheets', 'v4', cache_discovery=False, credentials=AnonymousCredentials(),
+                    client_options={'api_endpoint': url})
+    return service.spreadsheets()
@@ -0,0 +1,101 @@
+import csv
+
+
+def _to_float(val: str) -> float:
+    # Kovaaks writes some durations with a unit suffix, e.g. '0.412000s'
+    try:
+        return float(val.strip().rstrip('s'))
+    except ValueError:
+        return 0.0
+
+
+def _to_str(val: str) -> str:
+    return val.strip()
+
+
+# Summary rows at the bottom of a stats file, 'Label:' -> (RunRecord slot, converter)
+SUMMARY_FIELDS = {
+    'Kills:': ('kills', _to_float),
+    'Deaths:': ('deaths', _to_float),
+    'Fight Time:': ('fight_time', _to_float),
+    'Avg TTK:': ('avg_ttk', _to_float),
+    'Damage Done:': ('damage_done', _to_float),
+    'Damage Taken:': ('damage_taken', _to_float),
+    'Hit Count:': ('hit_count', _to_float),
+    'Miss Count:': ('miss_count', _to_float),
+    'Score:': ('score', float),  # no fallback, a broken score must not count as a 0 run
+    'Scenario:': ('scenario', _to_str),
+    'Challenge Start:': ('challenge_start', _to_str),
+    'Sens Scale:': ('sens_scale', _to_str),
+    'Horiz Sens:': ('horiz_sens', _to_float),
+    'Vert Sens:': ('vert_sens', _to_float),
+    'FOV:': ('fov', _to_float),
+}
+
+
+class RunRecord:
+    """ Everything read from a single Kovaaks stats file. The kill_* fields
+        are aggregated over the kill table and stay 0 unless requested. """
+
+    __slots__ = ('kills', 'deaths', 'fight_time', 'avg_ttk', 'damage_done', 'damage_taken',
+                 'hit_count', 'miss_count', 'score', 'scenario', 'challenge_start',
+                 'sens_scale', 'horiz_sens', 'vert_sens', 'fov',
+                 'shots', 'hits', 'kill_count', 'kill_ttk_total')
+
+    def __init__(self):
+        for slot, convert in SUMMARY_FIELDS.values():
+            setattr(self, slot, '' if convert is _to_str else 0.0)
+        self.shots = 0.0
+        self.hits = 0.0
+        self.kill_count = 0
+        self.kill_ttk_total = 0.0
+
+    @property
+    def accuracy(self) -> float:
+        # Prefer the weapon table, older files have no Hit/Miss Count rows
+        if self.shots:
+            return round(self.hits / self.shots, 4)
+        if self.hit_count + self.miss_count:
+            return round(self.hit_count / (self.hit_count + self.miss_count), 4)
+        return 0.0
+
+    @property
+    def kill_avg_ttk(self) -> float:
+        return self.kill_ttk_total / self.kill_count if self.kill_count else 0.0
+
+    def __repr__(self):
+        return f'RunRecord(scenario={self.scenario!r}, score={self.score}, accuracy={self.accuracy})'
+
+
+def read_run_from_file(file_path: str, kills: bool = False) -> RunRecord:
+    """ Parse a stats file in a single pass. Set kills to aggregate the
+        per-kill table into kill_count and kill_ttk_total as well. """
+    run = RunRecord()
+    table = None  # 'kills', 'weapons' or None while in the summary rows
+    ttk_col = 0
+
+    with open(file_path, newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if not row or not row[0]:
+                table = None
+                continue
+
+            head = row[0]
+            if table == 'kills':
+                if kills and len(row) > ttk_col:
+                    run.kill_count += 1
+                    run.kill_ttk_total += _to_float(row[ttk_col])
+            elif table == 'weapons' and len(row) > 2:
+                run.shots += _to_float(row[1])
+                run.hits += _to_float(row[2])
+            elif head == 'Kill #':
+                table = 'kills'
+                ttk_col = row.index('TTK') if 'TTK' in row else 4
+            elif head == 'Weapon':
+                table = 'weapons'
+            elif head in SUMMARY_FIELDS and len(row) > 1:
+                slot, convert = SUMMARY_FIELDS[head]
+                setattr(run, slot, convert(row[1]))
+
+    run.score = round(run.score, 1)
+    return run